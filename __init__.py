@@ -1,38 +1,18 @@
 from . import lexer
 from . import exceptions
 from . import tokens
+from . import parser
+from functools import lru_cache
 
 def parse(expression: str) -> tokens.Token:
-	prev_len = -1
-	tok = lexer.parse(expression.lower())
+	return parser.parse(expression)
 
-	#first pass to condense any globs and strings
-	pos = 0
-	while pos < len(tok):
-		prev_len = len(tok)
+#The same queries tend to get compiled over and over (saved searches, etc.), so cache their parsed form.
+#The cached trees are shared, so they aren't handed out. Output doesn't modify a tree,
+#and each call builds a fresh dict, which the caller is free to modify.
+@lru_cache(maxsize=1024)
+def _parse_cached(expression: str) -> tokens.Token:
+	return parse(expression)
 
-		if tok[pos].type() in ['Glob', 'String']:
-			tok = tok[pos].operate(tok, pos)
-		
-		if len(tok) == prev_len:
-			pos += 1
-
-	#then operate on all other tokens
-	while len(tok) > 1:
-		pos = 0
-		while pos < len(tok):
-			#only operate on tokens that haven't already been operated on
-			if len(tok[pos].children) == 0:
-				tok = tok[pos].operate(tok, pos)
-			if len(tok) != prev_len:
-				break
-			pos += 1
-
-		#if this round of parsing did not condense the expression,
-		#then some other syntax error happened.
-		if prev_len == len(tok):
-			raise exceptions.SyntaxError
-
-		prev_len = len(tok)
-
-	return tok[0] if len(tok) else tokens.NoneToken()
+def compile_query(expression: str, field: str = 'tags') -> dict:
+	return _parse_cached(expression).output(field)
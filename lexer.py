@@ -1,12 +1,15 @@
-__all__ = ['parse']
+__all__ = ['tokenize']
 
 import re
 from . import exceptions
 from . import tokens
 
-SPAC = re.compile(r'[ \t\n\r]*')
-OPER = re.compile(r'\band\b|\bor\b|\bnot\b|\+|/|\-')
-FUNC = re.compile(r'\b(eq|lt|gt|le|ge|equals?|exact(ly)?|min(imum)?|max(imum)?|fewer|greater|below|above)\b')
+#Keywords are case-insensitive, but tags keep their case.
+#The flag is inline so it survives being combined into TOKEN below.
+SPAC = re.compile(r'[ \t\n\r]+')
+GLOB = re.compile(r'\*')
+OPER = re.compile(r'(?i:\band\b|\bor\b|\bnot\b|\+|/|\-)')
+FUNC = re.compile(r'(?i:\b(eq|lt|gt|le|ge|equals?|exact(ly)?|min(imum)?|max(imum)?|fewer|greater|below|above)\b)')
 LPAR = re.compile(r'\(')
 RPAR = re.compile(r'\)')
 STR1 = re.compile(r'[a-zA-Z0-9_\.]+')
@@ -16,99 +19,117 @@ UNTR = re.compile(r'"[^"]*$')
 REGX = re.compile(r'\{[^\}]*\}')
 UNRG = re.compile(r'\{[^\}]*$')
 
-def consume(pattern: re.Pattern, expr: str, group: int = 0) -> str:
-	match = pattern.match(expr)
-	if match:
-		grp = match.group(group)
-		return grp, expr[len(match.group(0))::]
-	else:
-		return None, expr
-
-def parse(expr: str) -> list:
-	tok = []
-	while len(expr):
+#escape sequences recognized inside quoted strings
+ESCAPES = (
+	('\\"', '"'),
+	('\\\\', '\\'),
+	('\\t', '\t'),
+	('\\n', '\n'),
+	('\\r', '\r'),
+)
+
+#symbolic operators and their keyword equivalents
+OPER_ALIAS = {
+	'/': 'or',
+	'+': 'and',
+	'-': 'not',
+}
+
+#function names and their canonical short forms
+FUNC_ALIAS = {
+	'equal': 'eq',
+	'equals': 'eq',
+	'exact': 'eq',
+	'exactly': 'eq',
+	'min': 'ge',
+	'minimum': 'ge',
+	'max': 'le',
+	'maximum': 'le',
+	'fewer': 'lt',
+	'below': 'lt',
+	'greater': 'gt',
+	'above': 'gt',
+}
+
+#All token patterns, in order of priority, combined into one alternation
+#so the regex engine decides the token class in a single match.
+TOKEN = re.compile('|'.join(f'(?P<{name}>{pattern.pattern})' for name, pattern in [
+	('SPAC', SPAC),
+	('GLOB', GLOB),
+	('OPER', OPER),
+	('FUNC', FUNC),
+	('LPAR', LPAR),
+	('RPAR', RPAR),
+	('STR1', STR1),
+	('STR2', STR2),
+	('REGX', REGX),
+	('UNTR', UNTR),
+	('UNRG', UNRG),
+	('ANY', ANY),
+]))
+
+def tokenize(expr: str):
+	#scan with a cursor into the original string, rather than re-slicing it per token
+	pos = 0
+	while pos < len(expr):
+		match = TOKEN.match(expr, pos)
+
+		#if nothing matches (e.g. "&"), there's an error in the pattern
+		if match is None:
+			raise exceptions.InvalidSymbol(expr[pos])
+
+		kind = match.lastgroup
+		token = match.group()
+		pos = match.end()
+
 		#ignore whitespace
-		token, expr = consume(SPAC, expr)
+		if kind == 'SPAC':
+			continue
 
 		#glob operator
-		if len(expr) and expr[0] == '*':
-			expr = expr[1::]
-			tok += [ tokens.Glob('*') ]
-			continue
+		if kind == 'GLOB':
+			yield tokens.Glob('*')
 
 		#operators
-		token, expr = consume(OPER, expr)
-		if token is not None:
-			if token == '/': token = 'or'
-			if token == '+': token = 'and'
-			if token == '-': token = 'not'
-			tok += [ tokens.Operator(token) ]
-			continue
+		elif kind == 'OPER':
+			token = token.lower()
+			yield tokens.Operator(OPER_ALIAS.get(token, token))
 
 		#functions
-		token, expr = consume(FUNC, expr, group=1)
-		if token is not None:
-			if token[0] == 'e': token = 'eq'
-			elif token[0:3] == 'min': token = 'ge'
-			elif token[0:3] == 'max': token = 'le'
-			elif token in ['fewer', 'below']: token = 'lt'
-			elif token in ['greater', 'above']: token = 'gt'
-
-			tok += [ tokens.Function(token) ]
-			continue
+		elif kind == 'FUNC':
+			token = token.lower()
+			yield tokens.Function(FUNC_ALIAS.get(token, token))
 
 		#left paren
-		token, expr = consume(LPAR, expr)
-		if token is not None:
-			tok += [ tokens.LParen(token) ]
-			continue
+		elif kind == 'LPAR':
+			yield tokens.LParen(token)
 
 		#right paren
-		token, expr = consume(RPAR, expr)
-		if token is not None:
-			tok += [ tokens.RParen(token) ]
-			continue
+		elif kind == 'RPAR':
+			yield tokens.RParen(token)
 
 		#non-quoted words
-		token, expr = consume(STR1, expr)
-		if token is not None:
-			tok += [ tokens.String(token) ]
-			continue
+		elif kind == 'STR1':
+			yield tokens.String(token)
 
 		#quoted words
-		token, expr = consume(STR2, expr)
-		if token is not None:
-			escs = [
-				('\\"', '"'),
-				('\\\\', '\\'),
-				('\\t', '\t'),
-				('\\n', '\n'),
-				('\\r', '\r'),
-			]
-			for esc in escs:
+		elif kind == 'STR2':
+			for esc in ESCAPES:
 				token = token.replace(esc[0], esc[1])
-			tok += [ tokens.String(token[1:-1]) ]
-			continue
+			yield tokens.String(token[1:-1])
 
 		#regex
-		token, expr = consume(REGX, expr)
-		if token is not None:
-			tok += [ tokens.Regex(token[1:-1]) ]
-			continue
+		elif kind == 'REGX':
+			yield tokens.Regex(token[1:-1])
 
 		#if there's an unterminated string, that's an error
-		token, expr = consume(UNTR, expr)
-		if token is not None:
+		elif kind == 'UNTR':
 			raise exceptions.UnterminatedString
 
 		#if there's an unterminated regex, that's an error
-		token, expr = consume(UNRG, expr)
-		if token is not None:
+		elif kind == 'UNRG':
 			raise exceptions.BadRegex(token, 'unterminated regex')
 
 		#if anything else, there's an error in the pattern
-		token, expr = consume(ANY, expr)
-		if token is not None:
+		else:
 			raise exceptions.InvalidSymbol(token)
-
-	return tok
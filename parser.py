@@ -0,0 +1,273 @@
+__all__ = ['parse']
+
+from . import exceptions
+from . import lexer
+from . import tokens
+
+def parse(expression: str) -> tokens.Token:
+	#tokens are pulled from the lexer one at a time, with a single token of lookahead.
+	stream = words(lexer.tokenize(expression))
+	current_token = next(stream, None)
+
+	def peek() -> tokens.Token:
+		return current_token
+
+	def get() -> tokens.Token:
+		nonlocal current_token
+		tok = current_token
+		current_token = next(stream, None)
+		return tok
+
+	if peek() is None:
+		return tokens.NoneToken()
+
+	tok = expr(peek, get)
+
+	#anything left over couldn't be joined onto the expression.
+	if peek() is not None:
+		raise exceptions.SyntaxError
+
+	if tok.type is tokens.TType.OPERATOR:
+		tok.finish()
+	return tok
+
+def words(stream):
+	#Globs attach to the tag next to them before anything else is parsed, even parentheses,
+	#and runs of plain words are joined into one tag, so both happen on the token stream itself.
+	#A glob goes on the left of the word after it ("*a"), or else on the right of the word before it ("a*").
+	#A glob between two words splits them, and the parser decides whether they can still be joined.
+	word = None #the current word, held back until it's known whether a glob follows it
+	parts = []
+	glob = False
+
+	for tok in stream:
+		ttype = tok.type
+		if ttype is tokens.TType.GLOB:
+			glob = True
+			continue
+
+		if ttype is tokens.TType.STRING and word is not None and not glob:
+			parts += [tok.text]
+			continue
+
+		if glob:
+			if ttype is tokens.TType.STRING:
+				tok.glob_left = True
+			elif word is not None:
+				word.glob_right = True
+			else:
+				raise exceptions.BadGlob
+			glob = False
+
+		if word is not None:
+			word.text = ' '.join(parts)
+			yield word
+			word = None
+
+		if ttype is tokens.TType.STRING:
+			word = tok
+			parts = [tok.text]
+		else:
+			yield tok
+
+	if glob:
+		if word is None:
+			raise exceptions.BadGlob
+		word.glob_right = True
+
+	if word is not None:
+		word.text = ' '.join(parts)
+		yield word
+
+#The state of an expression that's been interrupted by a group, kept until the group is closed.
+class Frame:
+	__slots__ = ('lhs', 'op', 'oper', 'negate', 'func', 'parts')
+
+	def __init__(self):
+		self.lhs = None     #the expression so far
+		self.op = None      #the operator chain that lhs is, if it was built in this expression
+		self.oper = None    #binary operator waiting for its right operand
+		self.negate = False #whether the operand being parsed is negated
+		self.func = None    #function waiting for the group as its parameter
+		self.parts = None   #words waiting for the group to be joined onto them
+
+#Binary operators all bind equally tightly and associate to the left,
+#so "a and b or c" is "(a and b) or c".
+#Groups are handled with an explicit stack rather than by recursing, so deeply nested
+#queries can't hit the recursion limit: opening a group saves the state of the expression
+#it's in, and closing it hands the group's value back to that expression.
+def expr(peek, get) -> tokens.Token:
+	stack = []
+	state = Frame()
+	tok = None
+
+	while True:
+		if tok is None:
+			state.negate = unary(peek, get, state.negate)
+			tok = value(peek, get, state)
+
+			#the value is a group, which is parsed as an expression of its own.
+			if tok is None:
+				stack += [state]
+				state = Frame()
+				continue
+
+		elif state.func is not None:
+			tok = function(state.func, tok)
+			state.func = None
+
+		#Adjacent words are joined, even across groups, e.g. "a (b)" or "(a) b".
+		#This only happens for the first operand; anywhere else the operator takes the first word by itself.
+		nxt = peek()
+		if state.lhs is None and state.parts is None and tok.type is tokens.TType.STRING and nxt is not None and nxt.type in WORDS:
+			state.parts = []
+
+		if state.parts is not None:
+			#a group can only be joined on if it's just a word.
+			if tok.type is not tokens.TType.STRING or tok.negate:
+				raise exceptions.SyntaxError
+			state.parts += [tok]
+
+			if nxt is not None and nxt.type is tokens.TType.STRING:
+				tok = get()
+				continue
+
+			if nxt is not None and nxt.type is tokens.TType.LPAREN:
+				group(peek, get)
+				stack += [state]
+				state = Frame()
+				tok = None
+				continue
+
+			tok = state.parts[0]
+			tok.text = ' '.join(i.text for i in state.parts)
+			state.parts = None
+
+		if state.negate:
+			tok.negate = not tok.negate
+
+		if state.oper is None:
+			state.lhs = tok
+		else:
+			#a chain of the same operator just grows, e.g. "a or b or c"
+			if state.op is None or state.op.text != state.oper.text:
+				state.oper.add_child(state.lhs)
+				state.lhs = state.op = state.oper
+			state.op.add_child(tok)
+			state.oper = None
+
+		tok = None
+		if nxt is not None and nxt.type is tokens.TType.OPERATOR:
+			state.oper = get()
+
+			rhs = peek()
+			if rhs is None or rhs.type is tokens.TType.RPAREN or (rhs.type is tokens.TType.OPERATOR and rhs.text != 'not'):
+				raise exceptions.MissingOperand(state.oper.text)
+
+			# A not B -> A and not B
+			state.negate = False
+			if state.oper.text == 'not':
+				state.oper.text = 'and'
+				state.negate = True
+			continue
+
+		if len(stack) == 0:
+			return state.lhs
+
+		#the end of the current group
+		if nxt is None:
+			raise exceptions.MissingRightParen
+		if nxt.type is not tokens.TType.RPAREN:
+			raise exceptions.SyntaxError
+		get()
+
+		tok = state.lhs
+		state = stack.pop()
+
+def unary(peek, get, negate: bool) -> bool:
+	#NOT operator is unary when it starts an operand, and each one just flips the negation.
+	while peek() is not None and peek().type is tokens.TType.OPERATOR and peek().text == 'not':
+		oper = get()
+		if peek() is None:
+			raise exceptions.MissingOperand(oper.text)
+		negate = not negate
+
+	return negate
+
+#Parse a single value. If the value is (or needs) a group, the group is only opened, and None is returned.
+def value(peek, get, state: Frame) -> tokens.Token:
+	tok = peek()
+
+	if tok is None:
+		raise exceptions.SyntaxError
+
+	return VALUES[tok.type](peek, get, state)
+
+def word_value(peek, get, state: Frame) -> tokens.Token:
+	return get()
+
+def regex_value(peek, get, state: Frame) -> tokens.Token:
+	return get()
+
+def paren_value(peek, get, state: Frame) -> tokens.Token:
+	group(peek, get)
+	return None
+
+def group(peek, get) -> None:
+	get()
+	if peek() is None:
+		raise exceptions.MissingRightParen
+	if peek().type is tokens.TType.RPAREN:
+		get()
+		#"()" at the very end looks like the start of a group that never got closed.
+		if peek() is None:
+			raise exceptions.MissingRightParen
+		raise exceptions.EmptyParens
+
+def function_value(peek, get, state: Frame) -> tokens.Token:
+	tok = get()
+	param = peek()
+
+	#the param is either a word, or a group that has to reduce to one.
+	if param is not None and param.type is tokens.TType.LPAREN:
+		group(peek, get)
+		state.func = tok
+		return None
+
+	if param is None or param.type is not tokens.TType.STRING:
+		raise exceptions.MissingParam(tok.text)
+
+	return function(tok, get())
+
+def function(tok: tokens.Function, param: tokens.Token) -> tokens.Token:
+	#Currently, all functions require a precisely numeric param.
+	if param.type is not tokens.TType.STRING or not (param.text.isascii() and param.text.isdigit()):
+		raise exceptions.BadFuncParam(f'Parameter for "{tok.text}" must be an integer.')
+
+	tok.children = [ param ]
+	tok.count = int(param.text)
+	return tok
+
+def operator_value(peek, get, state: Frame) -> tokens.Token:
+	#a binary operator can't start a value.
+	raise exceptions.MissingOperand(peek().text)
+
+def bad_value(peek, get, state: Frame) -> tokens.Token:
+	raise exceptions.SyntaxError
+
+#token types that can be joined onto a word
+WORDS = (tokens.TType.STRING, tokens.TType.LPAREN)
+
+#How to parse a value starting with each type of token, indexed by token type.
+#Globs never get this far, since they're attached to words as the tokens are read.
+VALUES = (
+	word_value,     #STRING
+	operator_value, #OPERATOR
+	bad_value,      #GLOB
+	paren_value,    #LPAREN
+	bad_value,      #RPAREN
+	function_value, #FUNCTION
+	regex_value,    #REGEX
+	bad_value,      #NONE
+	bad_value,      #TOKEN
+)
@@ -0,0 +1,183 @@
+import re
+import time
+import unittest
+
+from .. import parse, compile_query
+from .. import exceptions
+
+#query -> expected output, taken from the behaviour of the original reduction parser.
+OUTPUTS = {
+	'': {},
+	'a': {'tags': 'a'},
+	'a b c': {'tags': 'a b c'},
+	'"a \\" b"': {'tags': 'a " b'},
+	'a and b': {'$and': [{'tags': 'a'}, {'tags': 'b'}]},
+	'a + b / c': {'$or': [{'$and': [{'tags': 'a'}, {'tags': 'b'}]}, {'tags': 'c'}]},
+	'a and b c': {'$and': [{'tags': 'a'}, {'tags': 'b c'}]},
+
+	#all binary operators bind equally tightly, left to right
+	'a and b or c': {'$or': [{'$and': [{'tags': 'a'}, {'tags': 'b'}]}, {'tags': 'c'}]},
+	'a or b and c': {'$and': [{'$or': [{'tags': 'a'}, {'tags': 'b'}]}, {'tags': 'c'}]},
+	'a or b or c': {'$or': [{'tags': 'a'}, {'tags': 'b'}, {'tags': 'c'}]},
+	'a and (b or c)': {'$and': [{'tags': 'a'}, {'$or': [{'tags': 'b'}, {'tags': 'c'}]}]},
+	'(a and b) and (c and d)': {'$and': [{'tags': 'a'}, {'tags': 'b'}, {'tags': 'c'}, {'tags': 'd'}]},
+
+	#not
+	'not a': {'tags': {'$ne': 'a'}},
+	'not not a': {'tags': 'a'},
+	'a not b': {'$and': [{'tags': 'a'}, {'tags': {'$ne': 'b'}}]},
+	'a - b': {'$and': [{'tags': 'a'}, {'tags': {'$ne': 'b'}}]},
+	'a and not not b': {'$and': [{'tags': 'a'}, {'tags': 'b'}]},
+	'not (a and b)': {'$or': [{'tags': {'$ne': 'a'}}, {'tags': {'$ne': 'b'}}]},
+	'a and not (b and c)': {'$and': [{'tags': 'a'}, {'$or': [{'tags': {'$ne': 'b'}}, {'tags': {'$ne': 'c'}}]}]},
+	'a or not (b and not (c or d))': {'$or': [{'tags': 'a'}, {'$or': [{'tags': {'$ne': 'b'}}, {'$or': [{'tags': 'c'}, {'tags': 'd'}]}]}]},
+
+	#adjacent words are joined, even across parentheses
+	'a (b)': {'tags': 'a b'},
+	'(a) b': {'tags': 'a b'},
+	'(a) (b)': {'tags': 'a b'},
+	'(a) b (c)': {'tags': 'a b c'},
+	'a ((b) c)': {'tags': 'a b c'},
+	'not (a) b': {'tags': {'$ne': 'a b'}},
+
+	#globs and regexes
+	'a*': {'tags': re.compile('^a')},
+	'*a': {'tags': re.compile('a$')},
+	'*a*': {'tags': re.compile('a')},
+	'a b*': {'tags': re.compile(r'^a\ b')},
+	'not a*': {'tags': {'$not': re.compile('^a')}},
+	'{ab.*}': {'tags': re.compile('ab.*')},
+
+	#globs attach to the word next to them before parentheses are matched,
+	#and a joined word keeps the globs of its first part.
+	'a* (b)': {'tags': re.compile(r'^a\ b')},
+	'(a*) b': {'tags': re.compile(r'^a\ b')},
+	'c * ( 1 * )': {'tags': re.compile(r'^c\ 1')},
+	'( b ) * 0': {'tags': 'b 0'},
+	'a * b': {'tags': 'a b'},
+	'a ** b': {'tags': 'a b'},
+
+	#functions
+	'eq 3': {'tags': {'$size': 3}},
+	'not eq 3': {'$or': [{'tags.2': {'$exists': False}}, {'tags.3': {'$exists': True}}]},
+	'lt 3': {'tags.2': {'$exists': False}},
+	'le 3': {'tags.3': {'$exists': False}},
+	'gt 3': {'tags.3': {'$exists': True}},
+	'ge 3': {'tags.2': {'$exists': True}},
+	'not gt 3': {'tags.3': {'$exists': False}},
+	'minimum 2': {'tags.1': {'$exists': True}},
+	'gt (3)': {'tags.3': {'$exists': True}},
+	'a and gt 3 or b': {'$or': [{'$and': [{'tags': 'a'}, {'tags.3': {'$exists': True}}]}, {'tags': 'b'}]},
+}
+
+#query -> expected exception
+ERRORS = {
+	'a and': exceptions.MissingOperand,
+	'and a': exceptions.MissingOperand,
+	'not': exceptions.MissingOperand,
+	'a and or b': exceptions.MissingOperand,
+	'eq': exceptions.MissingParam,
+	'gt x': exceptions.BadFuncParam,
+	'lt 0': exceptions.BadFuncParam,
+	'()': exceptions.MissingRightParen,
+	'(a': exceptions.MissingRightParen,
+	'(())': exceptions.EmptyParens,
+	'a)': exceptions.SyntaxError,
+	'a gt 3': exceptions.SyntaxError,
+	'(a or b) c': exceptions.SyntaxError,
+	'x and a (b)': exceptions.SyntaxError,
+	'x and a * b': exceptions.SyntaxError,
+	'"abc': exceptions.UnterminatedString,
+	'{abc': exceptions.BadRegex,
+	'{[}': exceptions.BadRegex,
+	'a $ b': exceptions.InvalidSymbol,
+	'*': exceptions.BadGlob,
+	'(a) *': exceptions.BadGlob,
+	'* (a)': exceptions.BadGlob,
+}
+
+class TestParser(unittest.TestCase):
+	def test_outputs(self):
+		for query, expected in OUTPUTS.items():
+			with self.subTest(query=query):
+				self.assertEqual(parse(query).output(), expected)
+
+	def test_errors(self):
+		for query, expected in ERRORS.items():
+			with self.subTest(query=query):
+				with self.assertRaises(expected):
+					parse(query).output()
+
+	def test_duplicates(self):
+		self.assertEqual(parse('a and a and b and a and b').output(), {'$and': [{'tags': 'a'}, {'tags': 'b'}]})
+		self.assertEqual(parse('a or (b or (a or c))').output(), {'$or': [{'tags': 'a'}, {'tags': 'b'}, {'tags': 'c'}]})
+		self.assertEqual(parse('(a or b) and (b or a)').output(), {'$and': [{'$or': [{'tags': 'a'}, {'tags': 'b'}]}]})
+		self.assertEqual(parse('a or not a').output(), {'$or': [{'tags': 'a'}, {'tags': {'$ne': 'a'}}]})
+		self.assertEqual(parse('a* or a').output(), {'$or': [{'tags': re.compile('^a')}, {'tags': 'a'}]})
+
+	def test_deep_nesting(self):
+		#Spotting duplicates must stay linear, however deeply the query is nested.
+		#"x0 or (x1 and (x2 or (..." twice, folded into one "or".
+		depth = 2000
+		query = ''.join(f'x{i} {"or" if i % 2 == 0 else "and"} (' for i in range(depth)) + 'y' + ')' * depth
+		start = time.perf_counter()
+		output = parse(f'({query}) or z or ({query})').output()
+		self.assertLess(time.perf_counter() - start, 2)
+		self.assertEqual(output['$or'][0], {'tags': 'x0'})
+		self.assertEqual(output['$or'][2], {'tags': 'z'})
+		self.assertEqual(len(output['$or']), 3)
+
+		#nested groups of the same operator are folded into one.
+		query = ''.join(f'x{i} or (' for i in range(depth)) + 'x0' + ')' * depth
+		start = time.perf_counter()
+		output = parse(query).output()
+		self.assertLess(time.perf_counter() - start, 2)
+		self.assertEqual(output, {'$or': [{'tags': f'x{i}'} for i in range(depth)]})
+
+	def test_deep_groups(self):
+		#nesting is limited only by memory, not by the recursion limit.
+		depth = 2000
+		self.assertEqual(parse('(' * depth + 'a' + ')' * depth).output(), {'tags': 'a'})
+		self.assertEqual(parse('not ' * (depth + 1) + 'a').output(), {'tags': {'$ne': 'a'}})
+		self.assertEqual(parse('gt ' + '(' * depth + '3' + ')' * depth).output(), {'tags.3': {'$exists': True}})
+
+		#"x0 or (x1 and (x2 or (..."
+		query = ''.join(f'x{i} {"or" if i % 2 == 0 else "and"} (' for i in range(depth)) + 'y' + ')' * depth
+		output = parse(query).output()
+		for i in range(depth):
+			key = '$or' if i % 2 == 0 else '$and'
+			self.assertEqual(output[key][0], {'tags': f'x{i}'})
+			output = output[key][1]
+		self.assertEqual(output, {'tags': 'y'})
+
+	def test_repeat_output(self):
+		#outputting a tree must not change it, and each call gets its own result.
+		tok = parse('not (a or b*)')
+		first = tok.output()
+		second = tok.output()
+		self.assertEqual(first, {'$and': [{'tags': {'$ne': 'a'}}, {'tags': {'$not': re.compile('^b')}}]})
+		self.assertEqual(first, second)
+		self.assertIsNot(first, second)
+		self.assertEqual(tok.output('x'), {'$and': [{'x': {'$ne': 'a'}}, {'x': {'$not': re.compile('^b')}}]})
+		self.assertEqual([i.negate for i in tok.children], [False, False])
+
+	def test_fresh_output(self):
+		#callers are free to modify the query they get back.
+		query = parse('').output()
+		query['owner'] = 1
+		self.assertEqual(parse('').output(), {})
+
+		query = parse('gt 3').output()
+		query['tags.3']['$exists'] = False
+		self.assertEqual(parse('gt 3').output(), {'tags.3': {'$exists': True}})
+
+		query = compile_query('a or b')
+		query['owner'] = 1
+		query['$or'] += [{'tags': 'c'}]
+		self.assertEqual(compile_query('a or b'), {'$or': [{'tags': 'a'}, {'tags': 'b'}]})
+
+	def test_field(self):
+		self.assertEqual(parse('a or gt 1').output('x'), {'$or': [{'x': 'a'}, {'x.1': {'$exists': True}}]})
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,242 +1,256 @@
 from . import exceptions
+from functools import lru_cache
+from enum import IntEnum
 import re
-
-INT = re.compile(r'^[0-9]+$')
+import weakref
+
+#Token types. Members are singletons, so they can be compared by identity.
+class TType(IntEnum):
+	STRING = 0
+	OPERATOR = 1
+	GLOB = 2
+	LPAREN = 3
+	RPAREN = 4
+	FUNCTION = 5
+	REGEX = 6
+	NONE = 7
+	TOKEN = 8
+
+#query keys for each operator
+OPER_KEY = {
+	'and': '$and',
+	'or': '$or',
+}
+
+#negating an operator swaps it for its De Morgan dual.
+NEGATE_OPER = {
+	'or': 'and',
+	'and': 'or',
+}
+
+#the same tags and patterns tend to recur across queries, so only compile each one once.
+@lru_cache(maxsize=4096)
+def compile_regex(pattern: str) -> re.Pattern:
+	return re.compile(pattern)
+
+@lru_cache(maxsize=4096)
+def compile_glob(text: str, left: bool, right: bool) -> re.Pattern:
+	text = re.escape(text)
+	if not left:
+		text = '^' + text
+	elif not right:
+		text = text + '$'
+	return compile_regex(text)
+
+#key for a specific index of an array field, e.g. "tags.3"
+@lru_cache(maxsize=4096)
+def index_key(field: str, index: int) -> str:
+	return f'{field}.{index}'
 
 def debug_print(tok, indent: int = 0) -> str:
-	output = ''
-	if type(tok) is list:
-		for i in tok:
-			output += '\n' + debug_print(i, indent)
-	else:
-		output = '  '*indent + f'{tok.__class__.__name__} ({tok.text})'
-		output += debug_print(tok.children, indent + 1)
-
-	return output
+	#walk the tree with an explicit stack, so deeply nested queries can't hit the recursion limit.
+	is_list = type(tok) is list
+	stack = [(i, indent) for i in reversed(tok)] if is_list else [(tok, indent)]
+	lines = []
+	while len(stack):
+		tok, indent = stack.pop()
+		lines += ['  '*indent + f'{tok.__class__.__name__} ({tok.text})']
+		stack += [(i, indent + 1) for i in reversed(tok.children)]
+
+	output = '\n'.join(lines)
+	return '\n' + output if is_list and len(lines) else output
+
+#Structural identity of an operator, used to spot duplicate operands.
+#Operators with the same structure share one key, so keys are compared by identity,
+#and comparing two never walks the subtrees under them, however deeply they're nested.
+class Key:
+	__slots__ = ('__weakref__',)
+
+#The key for each operator structure currently in use.
+#Entries go away by themselves once no operator is holding on to their key.
+KEYS = weakref.WeakValueDictionary()
 
 class Token:
+	type = TType.TOKEN
+
+	#tokens are small and numerous, so don't give each one a __dict__.
+	__slots__ = ('text', 'children', 'negate', 'glob_left', 'glob_right')
+
 	def __init__(self, text: str):
 		self.text = text
 		self.children = []
 		self.negate = False
-		self.glob = {
-			'left': False,
-			'right': False,
-		}
+		self.glob_left = False
+		self.glob_right = False
 
 	def __str__(self) -> str:
 		return debug_print(self)
 
-	def operate(self, tokens: list, pos: int) -> list:
-		return tokens
-
-	def output(self, field: str = 'tags'):
-		raise NotImplementedError(f'output() method is not implemented for {self.type()}.')
+	def key(self) -> tuple:
+		#Two tokens with the same key and negation match exactly the same things.
+		#A token's own negation isn't part of its key, since "not" may be applied after
+		#the key is built; instead, the parent pairs the two up (see entry()).
+		#Anything but an operator has at most a plain word below it, so its key is just a
+		#small tuple that's cheap to build whenever it's needed, and isn't kept.
+		return (self.type, self.text, self.glob_left, self.glob_right, tuple(i.entry() for i in self.children))
 
-	def type(self):
-		return self.__class__.__name__
+	def entry(self) -> tuple:
+		return (self.negate, self.key())
 
-	def coalesce(self) -> list:
-		#fold together children for operators of the same type.
-		kids = []
-		for child in self.children:
-			child.coalesce()
-			if child.type() == 'Operator' and self.text == child.text and not child.negate:
-				kids += child.children
-			else:
-				kids += [child]
-		self.children = kids
+	#"negate" is the negation applied by any enclosing operators, on top of the token's own.
+	def output(self, field: str = 'tags', negate: bool = False):
+		raise NotImplementedError(f'output() method is not implemented for {self.__class__.__name__}.')
 
 class NoneToken(Token):
+	type = TType.NONE
+	__slots__ = ()
+
 	def __init__(self):
-		pass
+		super().__init__('')
 
-	def output(self, field: str = 'tags') -> dict:
+	def output(self, field: str = 'tags', negate: bool = False) -> dict:
 		return {}
 
-#Glob tokens are guaranteed to either reduce or raise an exception.
-#They don't have to wait for other exprs to reduce since globs must be adjacent to strings.
 class Glob(Token):
-	def operate(self, tokens: list, pos: int) -> list:
-		#remove redundant globs
-		if pos < (len(tokens) - 1) and tokens[pos+1].type() == 'Glob':
-			return tokens[0:pos-1] + tokens[pos+1::]
-
-		#if next token is a string, glob on the left (*X)
-		if pos < (len(tokens) - 1) and tokens[pos+1].type() == 'String':
-			tokens[pos+1].glob['left'] = True
-			return tokens[0:pos] + tokens[pos+1::]
-
-		#if prev token is a string, glob on the right (X*)
-		elif pos > 0 and tokens[pos-1].type() == 'String':
-			tokens[pos-1].glob['right'] = True
-			return tokens[0:pos] + tokens[pos+1::]
-
-		raise exceptions.BadGlob
+	type = TType.GLOB
+	__slots__ = ()
 
 class Operator(Token):
-	def operate(self, tokens: list, pos: int) -> list:
-		#NOT operator is unary, unless by itself, then it's actually "and not".
-		if self.text == 'not' and (pos <= 0 or (tokens[pos-1].type() == 'Operator' and len(tokens[pos-1].children) == 0)):
-			if pos >= (len(tokens) - 1):
-				raise exceptions.MissingOperand(self.text)
-
-			rtype = tokens[pos+1].type()
-			rkids = len(tokens[pos+1].children)
-
-			#don't be greedy; let functions or other NOT opers try to get their param if they can.
-			if ((rtype == 'Function' or rtype == 'Operator') and rkids == 0) or rtype == 'LParen':
-				return tokens
-
-			if rtype not in ['String', 'Regex'] and rkids == 0:
-				raise exceptions.MissingOperand(self.text)
-
-			tokens[pos+1].negate = not tokens[pos+1].negate
-
-			return tokens[0:pos] + tokens[pos+1::]
-
-		#AND/OR operators start here
-
-		if pos == 0 or pos >= (len(tokens) - 1):
-			raise exceptions.MissingOperand(self.text)
-
-		ltype = tokens[pos-1].type()
-		lkids = len(tokens[pos-1].children)
-
-		rtype = tokens[pos+1].type()
-		rkids = len(tokens[pos+1].children)
-
-		#don't be greedy; let functions try to get their param if they can.
-		if (rtype == 'Function' and rkids == 0) or ltype == 'RParen' or rtype == 'LParen':
-			return tokens
-
-		if rtype == 'Operator' and tokens[pos+1].text == 'not' and rkids == 0:
-			return tokens
-
-		if (ltype not in ['String', 'Regex'] and lkids == 0) or (rtype not in ['String', 'Regex'] and rkids == 0):
-			raise exceptions.MissingOperand(self.text)
-
-		self.children = [ tokens[pos-1], tokens[pos+1] ]
-
-		# A not B -> A and not B
-		if self.text == 'not':
-			self.text = 'and'
-			self.children[1].negate = not self.children[1].negate
+	type = TType.OPERATOR
+	__slots__ = ('keys', 'ident')
 
+	def __init__(self, text: str):
+		super().__init__(text)
+		#entries of all children, so duplicate operands can be dropped as they're added.
+		#These, and the operator's own key, are only needed while it's being built; see finish().
+		self.keys = set()
+		self.ident = None
+
+	def key(self) -> Key:
+		#Built from the entries collected as children were added, so this must be called
+		#before finish(). Operand order doesn't matter, so "a or b" matches "b or a".
+		if self.ident is None:
+			self.ident = KEYS.setdefault((self.type, self.text, frozenset(self.keys)), Key())
+		return self.ident
+
+	def add_child(self, child: Token) -> None:
 		#fold together children for operators of the same type.
-		self.coalesce()
-
-		return tokens[0:pos-1] + [self] + tokens[pos+2::]
-
-	def output(self, field: str = 'tags') -> dict:
-		if len(self.children) == 0:
-			raise exceptions.MissingOperand(self.text)
-
-		neg = {
-			'or': 'and',
-			'and': 'or',
-		}
-		text = neg[self.text] if self.negate else self.text
-		if self.negate:
-			for child in self.children:
-				child.negate = not child.negate
-
-		return {
-			f'${text}': [ i.output(field) for i in self.children ]
-		}
+		if child.type is TType.OPERATOR and self.text == child.text and not child.negate:
+			self.fold(child)
+			child.keys = None
+			return
+
+		#"a and a" is just "a", so skip any duplicates.
+		entry = child.entry()
+		if entry not in self.keys:
+			self.keys.add(entry)
+			self.children += [child]
+
+		if child.type is TType.OPERATOR:
+			child.finish()
+
+	def fold(self, child: 'Operator') -> None:
+		#Merge the smaller side into the larger, so that folding
+		#deeply nested groups like "a or (b or (c or ...))" stays linear.
+		if len(child.children) <= len(self.children):
+			for i in child.children:
+				self.add_child(i)
+			return
+
+		keys = child.keys
+		if any(i in keys for i in self.keys):
+			kids = [i for i in child.children if i.entry() not in self.keys]
+		else:
+			kids = child.children
+		keys.update(self.keys)
+		self.children += kids
+		self.keys = keys
+
+	def finish(self) -> None:
+		#No more children will be added, so the keys used to spot duplicates can go.
+		#They aren't needed once the query is parsed, so don't keep them in the tree.
+		self.keys = None
+		for i in self.children:
+			if i.type is TType.OPERATOR:
+				i.ident = None
+
+	def output(self, field: str = 'tags', negate: bool = False) -> dict:
+		#walk the tree with an explicit stack, so deeply nested queries can't hit the recursion limit.
+		#Each entry is a token, the negation applied to it, and the list its output goes in.
+		result = []
+		stack = [(self, negate, result)]
+		while len(stack):
+			tok, negate, parent = stack.pop()
+			if tok.type is not TType.OPERATOR:
+				parent += [tok.output(field, negate)]
+				continue
+
+			if len(tok.children) == 0:
+				raise exceptions.MissingOperand(tok.text)
+
+			#not (A and B) -> (not A) or (not B), and vice versa.
+			#The negation is passed down rather than stored on the children, so output never modifies the tree.
+			negate = tok.negate != negate
+			text = NEGATE_OPER[tok.text] if negate else tok.text
+			children = []
+			parent += [{ OPER_KEY[text]: children }]
+			stack += [(i, negate, children) for i in reversed(tok.children)]
+
+		return result[0]
 
 class String(Token):
-	def operate(self, tokens: list, pos: int) -> list:
-		#Concatenate adjacent strings into a single string separated by spaces
-		if pos + 1 < len(tokens) and tokens[pos+1].type() == 'String':
-			self.text += f' {tokens[pos+1].text}'
-			return tokens[0:pos+1] + tokens[pos+2::]
-
-		return tokens
-
-	def output(self, field: str = 'tags') -> str:
-		globbing = self.glob['left'] or self.glob['right']
+	type = TType.STRING
+	__slots__ = ()
 
-		text = re.escape(self.text) if globbing else self.text
-		oper = '$not' if globbing else '$ne'
+	def output(self, field: str = 'tags', negate: bool = False) -> dict:
+		negate = self.negate != negate
 
-		if globbing:
-			if not self.glob['left']:
-				text = '^' + text
-			elif not self.glob['right']:
-				text = text + '$'
-			text = re.compile(text)
+		#most tags aren't globbed, so handle that first.
+		if not (self.glob_left or self.glob_right):
+			return {field: {'$ne': self.text}} if negate else {field: self.text}
 
-		return {field: {oper: text}} if self.negate else {field: text}
+		text = compile_glob(self.text, self.glob_left, self.glob_right)
+		return {field: {'$not': text}} if negate else {field: text}
 
 class Regex(Token):
-	def output(self, field: str = 'tags') -> dict:
+	type = TType.REGEX
+	__slots__ = ()
+
+	def output(self, field: str = 'tags', negate: bool = False) -> dict:
 		try:
-			return {field: re.compile(self.text)}
+			return {field: compile_regex(self.text)}
 		except re.error as e:
 			raise exceptions.BadRegex(self.text, str(e))
 
 class LParen(Token):
-	def operate(self, tokens: list, pos: int) -> list:
-		if pos >= (len(tokens) - 2):
-			raise exceptions.MissingRightParen
-
-		ptype = tokens[pos+1].type()
-		pkids = len(tokens[pos+1].children)
-
-		rtype = tokens[pos+2].type()
-
-		# inner expression hasn't been parsed yet, so exit early
-		if rtype != 'RParen':
-			return tokens
-
-		if ptype != 'String' and pkids == 0:
-			raise exceptions.EmptyParens
-
-		#fold together children for operators of the same type.
-		if ptype == 'Operator':
-			tokens[pos+1].coalesce()
-
-		return tokens[0:pos] + [tokens[pos+1]] + tokens[pos+3::]
+	type = TType.LPAREN
+	__slots__ = ()
 
 class RParen(Token):
-	pass
+	type = TType.RPAREN
+	__slots__ = ()
 
 class Function(Token):
-	def operate(self, tokens: list, pos: int) -> list:
-		if pos >= (len(tokens) - 1):
-			raise exceptions.MissingRightParen
-
-		ptype = tokens[pos+1].type()
-		pkids = len(tokens[pos+1].children)
+	type = TType.FUNCTION
+	__slots__ = ('count',)
 
-		# inner expression hasn't been parsed yet, so exit early
-		if ptype == 'LParen':
-			return tokens
-
-		if ptype != 'String' and pkids == 0:
-			raise exceptions.MissingParam(self.text)
-
-		#Currently, all functions require a precisely numeric param.
-		if ptype != 'String' or not INT.match(tokens[pos+1].text):
-			raise exceptions.BadFuncParam(f'Parameter for "{self.text}" must be an integer.')
-
-		self.children = [ tokens[pos+1] ]
-
-		return tokens[0:pos] + [self] + tokens[pos+2::]
+	def __init__(self, text: str):
+		super().__init__(text)
+		#the (integer) parameter, converted once while parsing.
+		self.count = None
 
-	def output(self, field: str = 'tags') -> dict:
+	def output(self, field: str = 'tags', negate: bool = False) -> dict:
 		if len(self.children) == 0:
 			raise exceptions.MissingParam(self.text)
 
-		#we know that the param will always be numeric, not an expression
-		count = int(self.children[0].text)
+		count = self.count
+		negate = self.negate != negate
 
 		if self.text == 'eq':
-			if self.negate:
+			if negate:
 				return {'$or': [
-					{ f'{field}.{count-1}': { '$exists': False } },
-					{ f'{field}.{count}': { '$exists': True } },
+					{ index_key(field, count-1): { '$exists': False } },
+					{ index_key(field, count): { '$exists': True } },
 				]}
 			else:
 				return { field: { '$size': count } }
@@ -245,15 +259,15 @@ class Function(Token):
 			#don't allow filtering for blobs with fewer than 0 tags, that doesn't make sense.
 			if count < 1:
 				raise exceptions.BadFuncParam(f'Parameter for "{self.text}" must be a positive integer.')
-			return { f'{field}.{count-1}': { '$exists': self.negate } }
+			return { index_key(field, count-1): { '$exists': negate } }
 		elif self.text == 'le':
-			return { f'{field}.{count}': { '$exists': self.negate } }
+			return { index_key(field, count): { '$exists': negate } }
 		elif self.text == 'gt':
-			return { f'{field}.{count}': { '$exists': not self.negate } }
+			return { index_key(field, count): { '$exists': not negate } }
 		elif self.text == 'ge':
 			#don't allow filtering for blobs with at least 0 tags, that's always true.
 			if count < 1:
 				raise exceptions.BadFuncParam(f'Parameter for "{self.text}" must be a positive integer.')
-			return { f'{field}.{count-1}': { '$exists': not self.negate } }
+			return { index_key(field, count-1): { '$exists': not negate } }
 
 		raise NotImplementedError(f'Output for function of type "{self.text}" is not implemented.')